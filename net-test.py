@@ -1,7 +1,17 @@
+import atexit
+import concurrent.futures
+import functools
+import hashlib
 import json
+import queue
+import threading
+import re
+import shlex
+import statistics
 import subprocess
 import csv
 import os
+import time
 from datetime import datetime, timedelta
 import logging.handlers
 import logging
@@ -9,6 +19,44 @@ import socket
 import argparse
 import configparser
 
+# Optional dependency: 'jc' (https://github.com/kellyjonbrazil/jc) maintains parser grammars for the output of
+# many CLI tools, including every common ping implementation. If it's installed we use it to extract fields from
+# ping output; if not, we fall back to our own regexes. Everything else in this script is stdlib-only.
+try:
+    import jc
+except ImportError:
+    jc = None
+
+# Optional dependency: 'orjson' is a C JSON encoder several times faster than the stdlib encoder. Only used for
+# writing the results file; stdlib json (with compact separators) is the fallback.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Optional dependency: 'icmplib' sends ICMP echo requests natively from Python (unprivileged datagram sockets
+# where the OS allows it). When installed, local-source latency tests skip the fork/exec of /usr/bin/ping and the
+# text parsing entirely - see run_ping_native(). Remote-source tests always go via SSH + ping.
+# Optional dependency: 'diskcache' provides a SQLite-backed cache with TTL expiry. When installed, successful
+# test results are persisted across runs and reused within a short window (ANT_CACHE_TTL, default 60s) - useful
+# when the script runs on a tight cron loop. Bypassed entirely with --no-cache. See run_unit_throttled().
+try:
+    import diskcache
+except ImportError:
+    diskcache = None
+
+try:
+    from icmplib import ping as icmp_ping
+    from icmplib.exceptions import ICMPLibError, SocketPermissionError
+except ImportError:
+    icmp_ping = None
+
+    class ICMPLibError(Exception):
+        """Placeholder so except-clauses can reference ICMPLibError even when icmplib isn't installed."""
+
+    class SocketPermissionError(ICMPLibError):
+        """Placeholder matching icmplib's exception hierarchy, for the same reason as above."""
+
 # This is the version number of the script. We are using SemVer (Semantic Versioning) system. The version number
 # consists of three numbers separated by dots. The first number is the major version, the second number is the minor
 # version, and the third number is the patch version. The major version is incremented when there are breaking changes.
@@ -32,6 +80,65 @@ LOGGING_LEVEL = logging.INFO  # can be overridden using the -V/--verbose argumen
 # Constants that users/devs may need to play with and change:
 TEST_TYPES = ["latency", "throughput", "jitter"]  # used in main code body loop
 DEFAULT_PING_INTERVAL = 0.2  # seconds between pings, used across all latency tests. Used in run_tests().
+MAX_WORKER_THREADS = 32  # upper bound on the number of tests run concurrently. Used in main().
+MAX_CONCURRENT_PER_SOURCE = 4  # max tests running at once on any single source host, to avoid overloading it.
+SOCKET_DEFAULT_TIMEOUT = 2.0  # seconds; bounds DNS lookups etc. so a broken resolver entry can't hang a thread.
+DNS_CACHE_TTL_SECONDS = 900  # how long resolve_hostname() memoizes a lookup before re-querying the OS resolver.
+
+# SSH connection multiplexing (ControlMaster) settings. Without multiplexing, every remote test pays the full
+# TCP + SSH key-exchange + auth handshake (typically 200-500ms); with it, one master connection per source host is
+# opened at startup and each test just attaches a new session to it. The %C placeholder is expanded by ssh itself
+# to a hash of local host + remote host + port + remote-user, giving one control socket per destination while
+# keeping the socket path short - Unix socket paths are limited to ~104-108 bytes (sun_path), which a literal
+# %h-%p-%r name can blow through with long FQDNs.
+SSH_CONTROL_DIR = "~/.ant"
+SSH_CONTROL_PATH = f"{SSH_CONTROL_DIR}/cm-%C"
+SSH_MULTIPLEX_OPTS = f"-o ControlMaster=auto -o ControlPath={SSH_CONTROL_PATH} -o ControlPersist=60s"
+SSH_MULTIPLEX_ARGS = SSH_MULTIPLEX_OPTS.split()  # same options as an argv fragment, for list-form subprocess calls
+
+# Per-source-host cache of whether that host's iperf3 supports --json-stream. See iperf3_has_json_stream().
+IPERF3_JSON_STREAM_CACHE = {}
+
+# In-run cache of completed test results, keyed on the exact command string, so duplicate rows in the input CSV
+# (same command, different id_number) execute once and reuse the result. See run_unit_throttled(). The lock
+# guards the dict against concurrent worker threads; RESULT_CACHE_ENABLED is cleared by --no-cache in main().
+RESULT_CACHE = {}
+RESULT_CACHE_LOCK = threading.Lock()
+RESULT_CACHE_ENABLED = True
+
+# Per-host reachability as determined by the startup preflight (see preflight_check_sources()). Hosts absent
+# from the dict (ie. local sources, or if the preflight didn't run) are assumed reachable.
+HOST_UP = {}
+
+# Cleared the first time icmplib reports that the kernel refuses unprivileged ICMP sockets (eg. RHEL-family
+# defaults, where net.ipv4.ping_group_range is '1 0'). Subsequent local latency tests then go straight to the
+# system ping instead of repeating the doomed native attempt on every test. See run_test().
+ICMP_NATIVE_OK = True
+
+# Cross-run result cache, only active when the optional 'diskcache' package is installed (main() opens it in the
+# results directory). Entries expire after DISK_CACHE_TTL_SECONDS; --no-cache leaves it closed.
+DISK_CACHE = None
+DISK_CACHE_DIRNAME = ".ant-cache"
+DISK_CACHE_TTL_SECONDS = int(os.environ.get("ANT_CACHE_TTL", 60))
+
+# Optional live metrics feed. When ANT_INFLUX_HOST is set, each result is also sent to InfluxDB as a UDP
+# line-protocol datagram the moment it completes, cutting result-to-dashboard latency from "whenever the JSONL
+# file is next ingested" to milliseconds. The JSONL file remains the durable record either way.
+INFLUX_HOST = os.environ.get("ANT_INFLUX_HOST")
+INFLUX_PORT = int(os.environ.get("ANT_INFLUX_PORT", 8089))
+
+# Matches the per-probe RTT that ping prints for each reply, eg. "64 bytes from 8.8.8.8: icmp_seq=0 ttl=117
+# time=23.4 ms". Unlike the summary "min/avg/max" line, whose wording varies between Linux/BSD/macOS ping
+# implementations, the "time=X ms" part of each reply line is the same everywhere. Compiled once at module level so
+# we don't pay the compilation cost on every call to parse_ping_results(). These are bytes patterns, run directly
+# on the raw subprocess output - ping output is ASCII, so there's nothing a decode would add except an extra copy
+# of the whole output (float() and int() accept the matched byte-strings directly).
+PING_RTT_REGEX = re.compile(rb"time=([\d.]+)\s*ms")
+
+# Matches the transmitted/received counts in ping's summary, eg. "10 packets transmitted, 10 packets received" on
+# macOS/BSD, or "10 packets transmitted, 10 received" on most Linux distros (the optional ' packets' covers both).
+# Compiled once at module level, same rationale as PING_RTT_REGEX above.
+PING_PACKETS_REGEX = re.compile(rb"(\d+) packets transmitted,\s+(\d+)(?: packets)? received")
 
 
 def get_cmdline_args() -> argparse.Namespace:
@@ -75,6 +182,19 @@ def get_cmdline_args() -> argparse.Namespace:
                         help=f"Interval between pings in seconds. Optional argument (defaults to "
                              f"{DEFAULT_PING_INTERVAL}). Used in ping/latency tests ONLY.")
 
+    parser.add_argument("-w", "--max-workers", type=int, metavar="<threads>",
+                        default=int(os.environ.get("ANT_CONCURRENCY", MAX_WORKER_THREADS)),
+                        help=f"Upper bound on the number of tests run concurrently. Optional argument (defaults "
+                             f"to the ANT_CONCURRENCY environment variable, or {MAX_WORKER_THREADS} if that is "
+                             f"unset). The per-source-host cap of {MAX_CONCURRENT_PER_SOURCE} still applies "
+                             f"regardless.")
+
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Disable reuse of results between tests with identical commands, both within this "
+                             "run and (if the optional diskcache package is installed) across recent runs. "
+                             "With caching on (the default), duplicate CSV rows execute once and share the "
+                             "result; pass this flag to force every row to execute independently.")
+
     parser.add_argument("-v", "--version", action="version", version=f"%(prog)s version {VERSION}",
                         help="Display the version number and exit.")
     parser.add_argument('-V', '--verbose', action='store_true',
@@ -83,6 +203,30 @@ def get_cmdline_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
+class CachedFormatter(logging.Formatter):
+    """
+    A logging.Formatter whose formatTime() caches the rendered timestamp string and only re-runs strftime when
+    the second actually rolls over. The file format includes %(asctime)s, which stock Formatter renders with a
+    fresh strftime per record - measurable overhead when a parallel run emits bursts of records within the same
+    second. Sub-second precision isn't lost: the .%(msecs)03d in the format string is appended per-record by the
+    normal formatting machinery. Only ever called from the QueueListener thread, so the two cache attributes
+    need no locking.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._last_second = None
+        self._last_asctime = ""
+
+    def formatTime(self, record, datefmt=None):
+        current_second = int(record.created)
+        if current_second != self._last_second:
+            self._last_second = current_second
+            self._last_asctime = time.strftime(datefmt or self.default_time_format,
+                                               time.localtime(current_second))
+        return self._last_asctime
+
+
 def setup_logging(name, log_level, file_path) -> logging.Logger:
     """
     Set up the logging for the script. This function is called at the start of the script, and returns a logger object
@@ -95,24 +239,40 @@ def setup_logging(name, log_level, file_path) -> logging.Logger:
     :return: logger object
     """
     logger = logging.getLogger(name)  # Create a custom logger that we can use throughout the program
+    if logger.handlers:
+        # Logger has already been set up (eg. setup_logging() called twice). Return it as-is rather than attaching
+        #  a second set of handlers, which would cause every message to be written to the log file twice.
+        return logger
     logger.setLevel(log_level)  # set to logging.DEBUG if you want additional output during development
     # Create handlers. Naming convention: c = console, f = file
     c_handler = logging.StreamHandler()
     f_handler = logging.handlers.TimedRotatingFileHandler(
         filename=file_path, when="D", interval=1, backupCount=60)  # rotate daily, keep 60 days worth of logs
-    c_handler.setLevel(logging.WARNING)  # determines the error-level (or above) that will be sent to console
+    c_handler.setLevel(logging.INFO)  # INFO so test results/progress reach the console through the logger; this
+    #  replaces the print()+logger.info() pairs the code used to carry, which wrote every message twice and cost
+    #  an unbuffered write() syscall per print under parallel execution
     f_handler.setLevel(logging.DEBUG)  # determines the error-level (or above) that will be sent to file
 
     # Create formatters and add it to handlers
     c_format = logging.Formatter("%(levelname)s: %(message)s")
-    f_format = logging.Formatter(fmt="%(asctime)s.%(msecs)03d - %(levelname)08s: %(funcName)s: %(message)s",
-                                 datefmt="%Y-%m-%d %H:%M:%S")
+    f_format = CachedFormatter(fmt="%(asctime)s.%(msecs)03d - %(levelname)08s: %(funcName)s: %(message)s",
+                               datefmt="%Y-%m-%d %H:%M:%S")
     c_handler.setFormatter(c_format)
     f_handler.setFormatter(f_format)
 
+    # Don't attach the file handler to the logger directly - every log call would then take the handler lock and
+    #  do a blocking write() to disk. Instead the logger gets a QueueHandler (a log call becomes a near-instant
+    #  queue.put), and a background QueueListener thread owns the real file handler and does the disk I/O. The
+    #  listener is stopped via atexit so any queued records are flushed to the file when the script exits.
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    listener = logging.handlers.QueueListener(log_queue, f_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+
     # Add handlers to the logger
     logger.addHandler(c_handler)
-    logger.addHandler(f_handler)
+    logger.addHandler(queue_handler)
 
     return logger
 
@@ -162,7 +322,10 @@ def read_input_file(filename) -> list:
     Any other rows that start with a # character will be ignored. This makes it possible to add more comments to the
     CSV file, or to comment out specific tests.
     :param filename: the name of the input CSV file
-    :return: a list of dictionaries, each representing a test to be run
+    :return: a list of dictionaries, each representing a test to be run. Note: the one-dict-per-row layout is
+    deliberate - every consumer (validation, command building, run_test) handles a test as a unit, and each test
+    then spends seconds blocked on ping/iperf3, so a columnar (struct-of-arrays) layout would not pay for its
+    added complexity here.
     """
 
     logger.debug(f"Reading input file {filename}.")
@@ -184,15 +347,16 @@ def read_input_file(filename) -> list:
             if row[0].startswith("#"):
                 # Skip rows starting with a hash character, but log this to the screen and to the logfile.
                 logger.warning(f"Skipping line {csv_line_num} in input file because it starts with a '#' character.")
-                logger.debug(f"\tContent of skipped line {csv_line_num}: {row}")
+                # %-style (lazy) formatting: the row is only stringified if DEBUG logging is actually enabled
+                logger.debug("\tContent of skipped line %s: %s", csv_line_num, row)
                 continue
             else:
                 row_dict: dict[str, any]    # suppresses IDE int -> str warning when csv_line_num is added to the dict
-                # We use .strip() on 'value' in case users include a space after the comma in the CSV file.
-                row_dict = {column_headers[i]: value.strip() if value != "" else None for i, value in enumerate(row)}
-                # Iterate over the dict and remove any key-value pairs where the value is None. This makes it easier to
-                #  assign default values to missing test command parameters in the test-running function(s).
-                row_dict = {k: v for k, v in row_dict.items() if v is not None}
+                # Build the row dict in a single comprehension: empty CSV values are simply not added (so missing
+                #  test command parameters can be defaulted later with dict.get()), rather than the old approach of
+                #  storing them as None and then filtering them out with a second comprehension over the dict.
+                #  We use .strip() on 'value' in case users include a space after the comma in the CSV file.
+                row_dict = {column_headers[i]: value.strip() for i, value in enumerate(row) if value != ""}
                 row_dict['csv_line_num'] = csv_line_num  # add a key to the dict to store the CSV line number
                 data.append(row_dict)
 
@@ -206,15 +370,15 @@ def host_config_validated_ok(tests: list) -> bool:
     :param tests: pass alL_tests from the main body as this argument
     :return: True if all source hostnames in the input CSV file are present in the host_config file, False otherwise.
     """
-    unique_hostnames = set()  # Using a set automatically prevents duplicates, as sets don't allow them
-    for t in tests:
-        unique_hostnames.add(t['source'])
+    # Using sets automatically prevents duplicates, and lets us find the missing hostnames with a single O(N+M)
+    #  set-difference operation instead of scanning a list of configured hosts once per unique source hostname.
+    unique_hostnames = {t.get('source', 'localhost') for t in tests}
     logger.debug(f"Found {len(unique_hostnames)} unique source hostnames in input CSV file.")
-    # Make a list of all hostnames in the host_config file
-    all_test_hosts = [host_config[section]['hostname'] for section in host_config.sections()]
+    # Make a set of all hostnames in the host_config file
+    all_test_hosts = {host_config[section]['hostname'] for section in host_config.sections()}
     logger.debug(f"Found {len(all_test_hosts)} source hostnames in host config file.")
     # Check if each unique test source host in the CSV has an entry in the host_config file. If not, then quit.
-    missing_hostnames = [hostname for hostname in unique_hostnames if hostname not in all_test_hosts]
+    missing_hostnames = unique_hostnames - all_test_hosts
     if missing_hostnames:
         logger.error(
             f"One or more source hostnames in input CSV are missing from host config file: {missing_hostnames}")
@@ -235,6 +399,8 @@ def test_data_validated_ok(test_data: list) -> bool:
     :return: True if all tests are valid, False if any errors are found
     """
     logger.debug("Validating test data in input file.")
+    seen_id_numbers = set()  # used to spot duplicate id_numbers in the same pass as the field checks
+    duplicate_id_numbers = set()
     for item in test_data:
         csv_line_num = item.get('csv_line_num', None)
         id_num = item.get('id_number', None)
@@ -260,11 +426,14 @@ def test_data_validated_ok(test_data: list) -> bool:
                          f"Value must be in the form '100M', '1G', etc.")
             return False
 
-    # Check for duplicate id_number values
-    id_numbers = [t['id_number'] for t in test_data]
-    duplicates = [item for item in set(id_numbers) if id_numbers.count(item) > 1]
-    if duplicates:
-        logger.error(f"Duplicate id_number values found in input file: {duplicates}")
+        # Track id_numbers as we go, so duplicates are caught in this same traversal rather than a second one. Set
+        #  membership tests are O(1), versus the O(N^2) cost of counting each id_number's occurrences in a list.
+        if id_num in seen_id_numbers:
+            duplicate_id_numbers.add(id_num)
+        seen_id_numbers.add(id_num)
+
+    if duplicate_id_numbers:
+        logger.error(f"Duplicate id_number values found in input file: {sorted(duplicate_id_numbers)}")
         return False
 
     logger.debug("All test data in input file has been validated successfully.")
@@ -280,27 +449,43 @@ def delete_old_result_files(directory: str, max_days: int) -> None:
     :return: None
     """
     match_prefix = results_prefix   # the naming prefix of the script's output files
-    match_suffix = ".json"  # the suffix of the script's output files
+    match_suffix = (".json", ".jsonl")  # current output files are .jsonl; .json covers pre-JSONL results files
     logger.info(f"Will delete files older than {max_days} days in directory '{directory}' "
-                f"with pattern '{match_prefix}*{match_suffix}'")
-    current_time = datetime.now()
-    for filename in os.listdir(directory):
-        if filename.startswith(match_prefix) and filename.endswith(match_suffix):
-            file_path = os.path.join(directory, filename)
-            file_stat = os.stat(file_path)
-            file_modified_time = datetime.fromtimestamp(file_stat.st_mtime)
-            file_age = current_time - file_modified_time
-            if file_age > timedelta(days=max_days):
-                os.remove(file_path)
-                logger.debug(f"Deleted old file: {filename} (age: {file_age.days} days)")
+                f"with prefix '{match_prefix}' and suffix in {match_suffix}")
+    cutoff_time = time.time() - (max_days * 86400)  # files modified before this epoch time get deleted
+
+    # os.scandir() is used instead of os.listdir() + os.stat() because each DirEntry carries cached stat data from
+    #  the directory read, so we avoid a separate stat() syscall for every file. With thousands of old results
+    #  files in the directory, that halves the syscall count of the cleanup.
+    with os.scandir(directory) as dir_entries:
+        for entry in dir_entries:
+            if entry.name.startswith(match_prefix) and entry.name.endswith(match_suffix):
+                file_modified_time = entry.stat().st_mtime
+                if file_modified_time < cutoff_time:
+                    os.remove(entry.path)
+                    file_age_days = int((time.time() - file_modified_time) // 86400)
+                    logger.debug(f"Deleted old file: {entry.name} (age: {file_age_days} days)")
+
+
+def rtt_statistics(rtt_samples: list) -> tuple:
+    """
+    Compute the summary statistics for a list of per-probe RTTs. Shared by every code path that produces latency
+    results (text parsing, native ICMP, and batch splitting), so all of them round and aggregate identically.
+    :param rtt_samples: list of per-probe RTTs in milliseconds (may be empty).
+    :return: a (min_rtt, avg_rtt, max_rtt, stddev_rtt) tuple, or (None, None, None, None) if there are no samples.
+    """
+    if not rtt_samples:
+        return None, None, None, None
+    return (min(rtt_samples), round(statistics.fmean(rtt_samples), 3),
+            max(rtt_samples), round(statistics.pstdev(rtt_samples), 3))
 
 
-def parse_ping_results(test_data: dict, raw_output: str) -> dict:
+def parse_ping_results(test_data: dict, raw_output: bytes) -> dict:
     """
     Parse the results of a ping test. This function takes a dictionary as input, containing the following
     keys: id_number, test_params, and raw_output. It returns a dictionary containing the parsed results.
     :param test_data: dictionary containing the test ID and parameters (source, dest, etc) of the test that was run.
-    :param raw_output: string containing the raw output from subprocess.check_output() for the ping test.
+    :param raw_output: bytes containing the raw output from subprocess.check_output() for the ping test.
     :return: a dictionary containing the parsed results of the ping test.
     """
     id_num = test_data['id_number']
@@ -308,45 +493,48 @@ def parse_ping_results(test_data: dict, raw_output: str) -> dict:
     dest = test_data['destination']
 
     # We set these values to None here, to avoid repeating the same 2 lines of code in the If statements
-    #  that detect: A) no min/avg/max line; B) >1 min/avg/max line; and C) running on Windows OS.
+    #  that detect: A) no RTT samples found; B) no 'packet loss' line; and C) running on Windows OS.
     min_rtt, avg_rtt, max_rtt, stddev_rtt = None, None, None, None
     packets_txd, packets_rxd, packet_loss_percent = None, None, None
-
-    # Isolate out the line in the ping output that contains the summary results
-    rtt_line = [line for line in raw_output.split('\n') if 'min/avg/max' in line]
-
-    # Ensure that if raw_output has 0, or >1 lines containing 'min/avg/max', then we handle it gracefully. We log
-    #  something, then do nothing else, because we've already set all the test result variables to None.
-    if len(rtt_line) == 0:
-        logger.error(f"Test ID {id_num}: No line found in ping output containing 'min/avg/max'. Skipping test. "
-                     f"Full output of test:\n{raw_output}")
-    elif len(rtt_line) > 1:  # This situation is extremely unlikely
-        logger.error(f"Test ID {id_num}: Multiple lines found in ping output containing 'min/avg/max'. Skipping "
-                     f"test. Full output of test:\n{raw_output}")
+    rtt_samples = []
+
+    # Extract the per-probe RTTs and packet counts from the output. If the optional 'jc' library is installed we
+    #  use its maintained ping grammar, which tracks the wording quirks of the various ping implementations for
+    #  us; otherwise the module-level regexes do the job. Either way, the summary statistics are computed below
+    #  from the raw samples - we deliberately ignore ping's own "min/avg/max" summary line, whose exact wording
+    #  varies between implementations (Linux says "rtt min/avg/max/mdev", BSD/macOS say "round-trip
+    #  min/avg/max/stddev") - so results are identical whichever extractor ran. Having the raw samples also lets
+    #  downstream consumers of the results JSON calculate medians/percentiles without re-running tests.
+    # The regexes run straight on the raw bytes - nothing decodes the output unless jc is installed (its parser
+    #  wants str) or we need to quote the output in an error message below.
+    if jc is not None:
+        try:
+            jc_data = jc.parse('ping', raw_output.decode(), quiet=True)
+            rtt_samples = [resp['time_ms'] for resp in jc_data.get('responses', [])
+                           if resp.get('time_ms') is not None]
+            packets_txd = jc_data.get('packets_transmitted')
+            packets_rxd = jc_data.get('packets_received')
+        except Exception as e:  # jc raises parser-specific errors; whatever happened, the regexes can still run
+            logger.warning(f"Test ID {id_num}: jc could not parse ping output ({e}). Falling back to regexes.")
+    if not rtt_samples:
+        rtt_samples = [float(rtt) for rtt in PING_RTT_REGEX.findall(raw_output)]
+    if packets_txd is None or packets_rxd is None:
+        packets_match = PING_PACKETS_REGEX.search(raw_output)
+        if packets_match is not None:
+            packets_txd, packets_rxd = int(packets_match.group(1)), int(packets_match.group(2))
+
+    if not rtt_samples:
+        logger.error(f"Test ID {id_num}: No per-probe RTTs (ie. 'time=X ms') found in ping output. Skipping test. "
+                     f"Full output of test:\n{raw_output.decode(errors='replace')}")
     else:
-        # Keep the text between " = " and " ms"
-        # Example ping output line: 'round-trip min/avg/max/stddev = 0.053/0.154/0.243/0.063 ms'
-        rtt_data = rtt_line[0].replace(" ms", "").split('=')[1].strip()
-
-        # rtt_data now looks something like this: '0.053/0.154/0.243/0.063' - so we split it by the '/'
-        min_rtt, avg_rtt, max_rtt, stddev_rtt = rtt_data.split('/')
-
-        # Create a list of any lines in the output that have 'packet loss' in them. There should only be one.
-        loss_lines = [line for line in raw_output.split('\n') if 'packet loss' in line]
-        if len(loss_lines) == 0:
-            logger.error(f"Test ID {id_num}: No line found in ping output containing 'packet loss'. Will record "
-                         f"RTT results but not tx/rx/lost packets. Full output of test:\n{raw_output}")
+        min_rtt, avg_rtt, max_rtt, stddev_rtt = rtt_statistics(rtt_samples)
+
+        if packets_txd is None or packets_rxd is None:
+            logger.error(f"Test ID {id_num}: No 'packets transmitted ... received' summary found in ping output. "
+                         f"Will record RTT results but not tx/rx/lost packets. Full output of test:\n"
+                         f"{raw_output.decode(errors='replace')}")
             success_msg_suffix = f"packet count data not found in ping output."
         else:
-            # Grab the transmitted packets, received packets, and % packet loss from loss_line. This will work
-            # for MacOS and most Linux OSes.
-            # Example line 1 (MacOS, Linux): "10 packets transmitted, 10 packets received, 0.0% packet loss"
-            # Example line 2 (some Linux): "10 packets transmitted, 10 received, 0.0% packet loss"
-            loss_line = loss_lines[0]
-            split_line = loss_line.split(', ')  # ['10 packets transmitted', '10 packets received', etc...]
-            packets_txd = int(split_line[0].split(' ')[0])  # ['10', 'packets', 'transmitted'] -> '10' -> 10
-            packets_rxd = int(split_line[1].split(' ')[0])  # ['10', 'packets', 'received'] -> '10' -> 10
-
             # It's hard to reliably parse loss% out of the string because some Linux OSes use slightly different
             # wording, or insert "+1 duplicates" in the middle of the string. So we calculate the loss ourselves.
             packet_loss_percent = round(((packets_txd - packets_rxd) / packets_txd) * 100, 4)
@@ -356,30 +544,29 @@ def parse_ping_results(test_data: dict, raw_output: str) -> dict:
         #  the variables for the specific test type. This enables output of short-form results in a one-line log entry.
         #  We could do this in run_test() but we'd need a block of if-logic that works out the test type then extracts
         #  the necessary key/value data from the results dict, then generates the appropriate message.
-        # Note: we're using a separate print() here because the logger will only display console messages if they're
-        #  at WARNING or above severity, and it's inappropriate to log success using a WARNING/ERROR severity.
-        success_msg = (f"Test ID {id_num} (src: '{source}', dst: '{dest}', ping): Success. Result: "
-                       f"{min_rtt}/{avg_rtt}/{max_rtt}/{stddev_rtt} ms (min/avg/max/*dev), " + success_msg_suffix)
-        print(success_msg)
-        logger.info(success_msg)
+        #  One logger.info() covers both console and logfile - the console handler sits at INFO level.
+        logger.info(f"Test ID {id_num} (src: '{source}', dst: '{dest}', ping): Success. Result: "
+                    f"{min_rtt}/{avg_rtt}/{max_rtt}/{stddev_rtt} ms (min/avg/max/*dev), " + success_msg_suffix)
 
     return {
         "min_rtt": min_rtt,
         "avg_rtt": avg_rtt,
         "max_rtt": max_rtt,
         "stddev_rtt": stddev_rtt,
+        "rtt_samples": rtt_samples,
         "packets_txd": packets_txd,
         "packets_rxd": packets_rxd,
         "packet_loss_percent": packet_loss_percent,
     }
 
 
-def parse_iperf_results(test_data: dict, raw_output: str) -> dict:
+def parse_iperf_results(test_data: dict, command_result: dict) -> dict:
     """
     Parse the results of an iPerf3 test. This function takes a dictionary as input, containing the following
     keys: id_number, test_params, and raw_output. It returns a dictionary containing the parsed results.
     :param test_data: a dictionary containing the test ID, test parameters, and the raw output of the test command.
-    :param raw_output: the raw output of the iperf3 test command that was run.
+    :param command_result: iPerf3's output as a dict, ie. with an 'end' key (or 'error'). For legacy --json runs
+    this is the whole decoded blob; for --json-stream runs it is reassembled by run_iperf3_streaming().
     :return: a dictionary containing the parsed results of the iPerf3 test.
     """
 
@@ -388,16 +575,14 @@ def parse_iperf_results(test_data: dict, raw_output: str) -> dict:
     source = test_data['source']
     dest = test_data['destination']
 
-    # Convert iPerf's JSON output to a Python dictionary
-    command_result = json.loads(raw_output)
-
     # There is a situation in which iPerf3 will run, but cannot connect to the server (connection refused, etc). and
     #  weirdly iPerf3/subprocess.check_output() will return exit code 0. Luckily iPerf3 returns JSON with an 'error'
     #  key whose value is a string explaining the error.
     if "error" in command_result:
         logger.error(f"Test ID {id_num} (src: '{source}', dst: '{dest}', {t_type}): Failure. iPerf3 encountered "
                      f"an error: '{command_result['error']}'")
-        logger.debug(f"Full JSON returned by iPerf3: {command_result}")
+        # %-style (lazy) formatting, so the full JSON dict is only stringified when DEBUG logging is enabled
+        logger.debug("Full JSON returned by iPerf3: %s", command_result)
         return {
             "error": command_result['error']
         }
@@ -424,51 +609,345 @@ def parse_iperf_results(test_data: dict, raw_output: str) -> dict:
 
     # Log output to the screen and to logfile. We do this in each specific parse function so that we have access to
     #  the variables for that specific test type. This allows us to output short-form results in a one-line log entry.
-    #  NOTE: We use a separate print() statement for the console output, because the logger will only display console
-    #  messages at WARNING level or above, so we can't use one logger.info() call to convey success to the console.
-    msg = f"Test ID {id_num} (src: '{source}', dst: '{dest}', {t_type}): Success. Result: {short_form_results}"
-    print(msg)
-    logger.info(msg)
+    #  One logger.info() covers both console and logfile - the console handler sits at INFO level.
+    logger.info(f"Test ID {id_num} (src: '{source}', dst: '{dest}', {t_type}): Success. "
+                f"Result: {short_form_results}")
 
     return parsed_results
 
 
-def parse_results(test_params: dict, raw_output: str) -> dict:
+def parse_results(test_params: dict, raw_output: bytes) -> dict:
     """
     Wrapper function to make the code inside run_test() tidier. It just calls the relevant parse function for the
     test type that was run. This abstraction layer also makes it easier add more test types in the future.
     :param test_params: a dict containing the parameters of the test that was run.
-    :param raw_output: the raw output of the test command that was run.
+    :param raw_output: the raw output of the test command that was run (bytes; parsers decode as/if needed).
     :return: whatever the wrapped parser functions return, which is a dict of test results.
     """
     if test_params['test_type'] == "latency":
         return parse_ping_results(test_params, raw_output)
     elif test_params['test_type'] in ["throughput", "jitter"]:
-        return parse_iperf_results(test_params, raw_output)
+        return parse_iperf_results(test_params, json.loads(raw_output))
 
 
-def run_test(test_params: dict) -> dict:
+def dumps_jsonl(record: dict) -> bytes:
     """
-    Run a test based on the parameters in the input dictionary. The dictionary should contain the following keys:
-    - id_num: a unique identifier for the test. Mandatory.
-    - source: the source IP or hostname for the test. Used for constructing the test command (ie. local or SSH).
-    Default is 'localhost' if not supplied.
-    - destination: the destination IP or hostname for the test. Mandatory.
-    - count: the number of pings to send (optional; default 10)
-    - size: the size of the ping packet (optional; default 56 bytes)
-    :param test_params: a dictionary containing the parameters for the test
-    :return: a dictionary containing the results of the test
+    Serialize one results record to a newline-terminated JSON line, as bytes ready to write to the (binary-mode)
+    results file. Uses orjson when installed - it encodes straight to compact bytes and appends the newline
+    itself - otherwise the stdlib encoder with compact separators. Output is identical either way.
+    :param record: the results dict for one test, as returned by run_test().
+    :return: the record as one JSONL line (bytes, including the trailing newline).
+    """
+    if orjson is not None:
+        return orjson.dumps(record, option=orjson.OPT_APPEND_NEWLINE)
+    return json.dumps(record, separators=(',', ':')).encode() + b'\n'
+
+
+def _escape_influx_tag(value) -> str:
+    """
+    Escape a tag value for InfluxDB line protocol: commas, spaces and equals signs in tag values must be
+    backslash-escaped (and backslashes themselves first, so we don't double-escape what we just added).
+    :param value: the raw tag value (stringified if not already a string).
+    :return: the escaped tag value.
+    """
+    return str(value).replace('\\', '\\\\').replace(',', '\\,').replace(' ', '\\ ').replace('=', '\\=')
+
+
+def influx_line(record: dict) -> bytes:
+    """
+    Render one results record as an InfluxDB line-protocol line, eg.
+    "latency,id_number=3,source=hostA,destination=hostB min_rtt=1.2,avg_rtt=1.5,... 1712345678901234567\\n".
+    The test type is the measurement name; id_number/source/destination become tags; every numeric value in the
+    record becomes a field (plus status as a string field, so failures are visible even when no numbers were
+    produced); the raw time_ns start time is the line's timestamp. Must therefore be called before the
+    collection loop renders the timestamp to its ISO string.
+    :param record: the results dict for one test, as returned by run_test() (timestamp still in ns).
+    :return: the record as one line-protocol line (bytes, including the trailing newline).
+    """
+    tags = ",".join(f"{key}={_escape_influx_tag(record[key])}"
+                    for key in ("id_number", "source", "destination") if record.get(key) is not None)
+    fields = [f'status="{record["status"]}"']
+    fields += [f"{key}={value}" for key, value in record.items()
+               if isinstance(value, (int, float)) and not isinstance(value, bool) and key != "timestamp"]
+    return f"{record['test_type']},{tags} {','.join(fields)} {record['timestamp']}\n".encode()
+
+
+@functools.lru_cache(maxsize=1024)
+def _resolve_hostname_cached(hostname: str, ttl_bucket: int) -> str:
+    """
+    The memoized resolver behind resolve_hostname(). The ttl_bucket argument exists purely to be part of the
+    cache key: callers pass the current epoch divided by DNS_CACHE_TTL_SECONDS, so the same hostname gets a fresh
+    lookup once per TTL window and a cache hit within it. The cache is bounded (1024 entries) so it can't grow
+    without limit if a future caller feeds it an unbounded stream of names.
+    :param hostname: the hostname to resolve.
+    :param ttl_bucket: the current TTL window number (see resolve_hostname()).
+    :return: the IP address as a string (whatever socket.gethostbyname() returns).
+    """
+    return socket.gethostbyname(hostname)
+
+
+def resolve_hostname(hostname: str) -> str:
+    """
+    Resolve a hostname to an IP address via the OS resolver (/etc/hosts, then DNS), with in-process caching. On a
+    misconfigured resolver a single lookup can take hundreds of milliseconds, and there is no reason to pay that
+    more than once per hostname - but a single run of this script can also sit in a cron loop inside a
+    long-lived wrapper, so entries expire after DNS_CACHE_TTL_SECONDS rather than living forever (a host that
+    moves IP mid-window is picked up at the next window). Strings that are already IP addresses skip the resolver
+    and the cache entirely.
+    :param hostname: the hostname (or IP address literal) to resolve.
+    :return: the IP address as a string.
+    """
+    try:
+        socket.inet_aton(hostname)
+        return hostname  # already an IPv4 literal - nothing to resolve, nothing worth caching
+    except OSError:
+        pass
+    return _resolve_hostname_cached(hostname, int(time.time() // DNS_CACHE_TTL_SECONDS))
+
+
+def preflight_check_sources(remote_sources: set) -> None:
+    """
+    Check each remote source host for reachability before any tests run, by attempting a plain TCP connection to
+    its SSH port with a short timeout. Results land in the module-level HOST_UP dict, and run_test() short-
+    circuits tests whose source failed the check. Without this, every test against a dead host would wait out
+    the full SSH connect timeout before failing - twenty tests through one unreachable host is minutes of wasted
+    wall time for an answer the first connection attempt already gave us. The checks run in their own small
+    thread pool so N dead hosts cost one timeout, not N.
+    :param remote_sources: set of remote source hostnames (same set passed to open_ssh_masters()).
+    :return: None
+    """
+    if not remote_sources:
+        return
+
+    def check(source: str) -> bool:
+        try:
+            with socket.create_connection((source, 22), timeout=SOCKET_DEFAULT_TIMEOUT):
+                return True
+        except OSError:
+            return False
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(remote_sources)) as pool:
+        for source, up in zip(remote_sources, pool.map(check, remote_sources)):
+            HOST_UP[source] = up
+            if not up:
+                logger.warning(f"Preflight: source host '{source}' is unreachable on port 22 - its tests will "
+                               f"be recorded as failures without attempting SSH.")
+
+
+def open_ssh_masters(remote_sources: set) -> None:
+    """
+    Open one persistent SSH master connection per remote source host, so that the per-test ssh invocations in
+    run_test() just attach a session to an existing connection instead of each paying the full TCP + key-exchange +
+    auth handshake. Failure to open a master is only a warning: with ControlMaster=auto, tests for that host will
+    transparently fall back to one connection per test (slower, but correct).
+    :param remote_sources: set of source hostnames that are not the local machine.
+    :return: None
+    """
+    os.makedirs(os.path.expanduser(SSH_CONTROL_DIR), exist_ok=True)
+    for source in remote_sources:
+        username = host_config.get(source, 'username')
+        command = ["ssh", "-fNM"] + SSH_MULTIPLEX_ARGS + ["-o", "ConnectTimeout=2", f"{username}@{source}"]
+        logger.debug(f"Opening SSH master connection to {source}: {shlex.join(command)}")
+        result = subprocess.run(command, capture_output=True)
+        if result.returncode != 0:
+            logger.warning(f"Could not open SSH master connection to '{source}' "
+                           f"(exit code {result.returncode}: {result.stderr.decode().strip()}). Tests for this "
+                           f"host will each open their own SSH connection.")
+
+
+def close_ssh_masters(remote_sources: set) -> None:
+    """
+    Tear down the SSH master connections opened by open_ssh_masters(). Errors are ignored because a master may
+    never have come up in the first place, and ControlPersist would reap an orphaned one shortly anyway.
+    :param remote_sources: the same set of source hostnames that was passed to open_ssh_masters().
+    :return: None
+    """
+    for source in remote_sources:
+        username = host_config.get(source, 'username')
+        logger.debug(f"Closing SSH master connection to {source}.")
+        subprocess.run(["ssh", "-o", f"ControlPath={SSH_CONTROL_PATH}", "-O", "exit", f"{username}@{source}"],
+                       capture_output=True)
+
+
+def run_unit_throttled(unit: list, source_semaphores: dict) -> list:
+    """
+    Thin wrapper for use with the thread pool: run one dispatch unit (see group_latency_batches()) under its
+    source host's semaphore, which caps how many tests can be hammering any one source host at the same time
+    (MAX_CONCURRENT_PER_SOURCE), regardless of how many worker threads the pool has overall. Every test in a
+    unit has the same source by construction, so one semaphore acquisition covers the whole unit.
+
+    Single-test units also go through the in-run result cache (RESULT_CACHE): the first unit to arrive for a
+    given command claims the cache key with an in-flight marker and executes; duplicates submitted in parallel
+    wait on that marker ("single-flight") and reuse the result under their own id_number, with a 'cached_from'
+    key naming the test that actually ran. Without the marker, all duplicates would check the cache before any
+    of them had finished and every one would execute - the pool runs all units up front. If diskcache is
+    installed, successful results are also persisted and reused across runs within DISK_CACHE_TTL_SECONDS - see
+    DISK_CACHE. Both layers are disabled with --no-cache. Batched units never hit the cache - identical latency
+    tests are already coalesced into one invocation by group_latency_batches(), which is the stronger
+    optimization.
+    :param unit: a list of test dicts - a single test, or a batch of coalesced identical latency tests.
+    :param source_semaphores: dict mapping each source hostname to its threading.Semaphore.
+    :return: a list of per-test result dicts (always a list, even for a single test).
+    """
+    if len(unit) > 1:
+        with source_semaphores[unit[0].get('source', 'localhost')]:
+            return run_latency_batch(unit)
+
+    test = unit[0]
+    cache_key = test['_cmd_str']
+    disk_key = hashlib.blake2b(cache_key.encode(), digest_size=16).hexdigest()
+    in_flight = None  # the marker we installed, if this thread is the one elected to actually run the command
+    if RESULT_CACHE_ENABLED:
+        with RESULT_CACHE_LOCK:
+            entry = RESULT_CACHE.get(cache_key)
+            if entry is None:
+                # First arrival for this command: claim the key, so parallel duplicates wait for us below
+                #  instead of all missing the cache and all executing.
+                in_flight = RESULT_CACHE[cache_key] = threading.Event()
+        if isinstance(entry, threading.Event):
+            # An identical command is executing on another worker right now - wait for it rather than running
+            #  the same command again. The claimant is by definition an active worker thread, so this resolves.
+            entry.wait()
+            with RESULT_CACHE_LOCK:
+                entry = RESULT_CACHE.get(cache_key)
+        if isinstance(entry, dict):
+            logger.info(f"Test ID {test['id_number']}: an identical command already ran this run as test ID "
+                        f"{entry['id_number']} - reusing its result (disable with --no-cache).")
+            return [{**entry, "id_number": test['id_number'], "cached_from": entry['id_number']}]
+        # Reaching here without having claimed the key means the in-flight run died without publishing a
+        #  result (its exception is propagating separately); just run the test ourselves, uncached.
+        if in_flight is not None and DISK_CACHE is not None and (cached := DISK_CACHE.get(disk_key)) is not None:
+            # Cross-run hit: the same command succeeded within the last DISK_CACHE_TTL_SECONDS, typically on the
+            #  previous cron iteration. The record keeps its original timestamp - that's when the measurement
+            #  was actually taken. Publish it in-run too, so duplicates behind the marker reuse it directly.
+            logger.info(f"Test ID {test['id_number']}: an identical command succeeded within the last "
+                        f"{DISK_CACHE_TTL_SECONDS}s in a previous run - reusing its result (disable with "
+                        f"--no-cache).")
+            with RESULT_CACHE_LOCK:
+                RESULT_CACHE[cache_key] = dict(cached)
+            in_flight.set()
+            return [{**cached, "id_number": test['id_number'], "cached_from": "previous run"}]
+
+    try:
+        with source_semaphores[test.get('source', 'localhost')]:
+            result = run_test(test)
+    except BaseException:
+        # Whatever went wrong, never leave duplicates waiting on a marker that will now never be published.
+        if in_flight is not None:
+            with RESULT_CACHE_LOCK:
+                RESULT_CACHE.pop(cache_key, None)
+            in_flight.set()
+        raise
+
+    if in_flight is not None:
+        # Publish a shallow snapshot, not the dict we hand back - the collection loop mutates the returned dict
+        #  (timestamp rendering), and a cache entry must stay in the raw shape run_test() produced - then
+        #  release any duplicates that queued up behind this execution.
+        snapshot = dict(result)
+        with RESULT_CACHE_LOCK:
+            RESULT_CACHE[cache_key] = snapshot
+        in_flight.set()
+        if DISK_CACHE is not None and result["status"] == "Success":
+            # Only successes persist across runs - caching a transient failure for the TTL window would hide a
+            #  host's recovery from the very next run.
+            DISK_CACHE.set(disk_key, snapshot, expire=DISK_CACHE_TTL_SECONDS)
+    return [result]
+
+
+def iperf3_has_json_stream(source: str, is_local: bool) -> bool:
+    """
+    Check whether the iperf3 build on the given source host supports the --json-stream option (first shipped in
+    iperf3 3.17), by looking for the option in that host's 'iperf3 --help' output. The answer is cached in
+    IPERF3_JSON_STREAM_CACHE so each source host is probed at most once per run; remote probes ride the SSH master
+    connections opened at startup, so they cost one multiplexed round-trip rather than a full handshake.
+    :param source: the source hostname the iperf3 command will run on.
+    :param is_local: True if the source is the local machine (probe runs directly rather than over SSH).
+    :return: True if that host's iperf3 understands --json-stream, False otherwise (including probe failure).
+    """
+    if source in IPERF3_JSON_STREAM_CACHE:
+        return IPERF3_JSON_STREAM_CACHE[source]
+
+    if is_local:
+        probe_command = ["iperf3", "--help"]
+    else:
+        username = host_config.get(source, 'username')
+        probe_command = (["ssh", "-n"] + SSH_MULTIPLEX_ARGS
+                         + ["-o", "ConnectTimeout=2", f"{username}@{source}", "iperf3 --help"])
+    try:
+        result = subprocess.run(probe_command, capture_output=True)
+        supported = b"--json-stream" in result.stdout + result.stderr
+    except OSError as e:
+        # iperf3 (or ssh, for a remote probe) isn't installed on this machine. Record 'no streaming support' -
+        #  the command is then built with the legacy --json flag, and the missing binary surfaces as a per-test
+        #  failure in run_test() like every other missing-binary case, instead of killing the run at startup.
+        logger.warning(f"Could not probe iperf3 capabilities on '{source}' ({e}); assuming no --json-stream "
+                       f"support.")
+        supported = False
+    IPERF3_JSON_STREAM_CACHE[source] = supported
+    logger.debug(f"iperf3 on '{source}' {'supports' if supported else 'does not support'} --json-stream.")
+    return supported
+
+
+def run_iperf3_streaming(test_command: list) -> dict:
+    """
+    Execute an iperf3 command that uses --json-stream, reading the line-delimited JSON events as they arrive
+    instead of buffering one giant JSON blob until the test finishes. Only the 'end' summary event (and any
+    'error' event) is retained, so memory stays O(1) no matter how long the test runs or how many interval
+    records iperf3 emits.
+    :param test_command: the full (possibly SSH-wrapped) iperf3 command to run, as an argv list.
+    :return: a dict shaped like iperf3's legacy --json output, ie. containing an 'end' key, or 'error' on failure.
+    """
+    proc = subprocess.Popen(test_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    end_data = None
+    error_data = None
+    recent_lines = []  # small tail of raw output kept for the failure log, since we don't buffer the whole stream
+    for line in proc.stdout:
+        if len(recent_lines) >= 20:
+            recent_lines.pop(0)
+        recent_lines.append(line)
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            event = json.loads(line)
+        except ValueError:
+            continue  # eg. stderr noise interleaved into the stream - ignore anything that isn't a JSON event
+        if event.get("event") == "end":
+            end_data = event.get("data")
+        elif event.get("event") == "error":
+            error_data = event.get("data")
+
+    returncode = proc.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, test_command, output=b"".join(recent_lines))
+
+    if error_data is not None:
+        return {"error": error_data}
+    if end_data is None:
+        # The process exited 0 but never sent an 'end' event - treat it like iPerf3's soft-failure JSON.
+        return {"error": "no 'end' event received from iperf3 --json-stream output"}
+    return {"end": end_data}
+
+
+def build_command(test_params: dict) -> list:
+    """
+    Construct the complete command for a single test as an argv list, including the SSH wrapper when the test's
+    source is a remote host. An argv list (rather than a shell string with shell=True) means subprocess exec's
+    ping/iperf3/ssh directly instead of forking an intermediate /bin/sh per test, and means a hostile hostname in
+    the CSV can't inject shell syntax. This is called once per test up-front (see prepare_tests()) rather than
+    from inside run_test(), so the command assembly, default substitution and local-vs-remote decision happen
+    exactly once per test instead of on the hot path of every (possibly parallel) invocation.
+    :param test_params: a dictionary containing the parameters for the test, including the '_is_local' key.
+    :return: the full command to execute for this test, as an argv list.
     """
     id_num = test_params['id_number']  # this is a required field, so we can assume it's present
     source = test_params.get('source', 'localhost')  # if value was missing from CSV, assume 'localhost'
     destination = test_params['destination']  # required field
-    username = host_config.get(source, 'username')  # get this host's username from the host_config file
 
     if test_params['test_type'] == "latency":
         size = test_params.get('size', 56)  # optional field; go for 56 byte packet size if not specified
         count = test_params.get('count', 10)  # optional field; set default of 10 pings if not specified
-        interval = PING_INTERVAL
-        test_command = f"ping -c {count} -i {interval} -s {size} {destination}"
+        test_command = ["ping", "-c", str(count), "-i", str(PING_INTERVAL), "-s", str(size), destination]
 
     elif test_params['test_type'] == "throughput":
         size = test_params.get('size', None)  # mandatory for throughput tests - throw exception if missing
@@ -477,50 +956,229 @@ def run_test(test_params: dict) -> dict:
             raise ValueError(
                 f"Size parameter missing for test {id_num}. This field is required for throughput tests.")
         else:
-            test_command = f"iperf3 -c {destination} -n {size} -4 --json"
+            # --json-stream (when the host's iperf3 has it) lets run_test() parse output incrementally rather
+            #  than buffering one big JSON blob; older iperf3 builds fall back to legacy --json.
+            json_flag = "--json-stream" if iperf3_has_json_stream(source, test_params['_is_local']) else "--json"
+            test_command = ["iperf3", "-c", destination, "-n", str(size), "-4", json_flag]
     elif test_params['test_type'] == "jitter":
-        test_command = f"iperf3 -c {destination} -u -4 --json"
+        json_flag = "--json-stream" if iperf3_has_json_stream(source, test_params['_is_local']) else "--json"
+        test_command = ["iperf3", "-c", destination, "-u", "-4", json_flag]
     else:
         logger.error(f"Unknown test type '{test_params['test_type']}' for test {id_num}. Skipping test.")
         raise ValueError(f"Unknown test type '{test_params['test_type']}' for test {id_num}. Skipping test.")
 
-    # Get the current machine's hostname, FQDN and name-lookup the IP from the hostname. The user should not ever be
-    #  putting an IP address into the 'source' field, but in case they do, we'll try to handle it gracefully. Also
-    #  note that on some systems (particularly home networks) gethostname() will include ".local" or ".gateway".
-    if source in [my_hostname, my_fqdn, my_ip_addr, "localhost", "127.0.0.1"]:
+    if test_params['_is_local']:
         # Run the test locally - do nothing here, because test_command already = a local test
         logger.info(f"Test ID {id_num} source '{source}' matches local machine details. Test will be run locally.")
     else:
-        # Wrap test_command in an SSH command to run the test on a remote machine
+        # Wrap test_command in an SSH command to run the test on a remote machine. The multiplexing options make
+        #  this attach to the persistent master connection opened at startup (see open_ssh_masters()).
         logger.info(f"Test ID {id_num} source '{source}' is not local machine. Constructing SSH remote command.")
-        test_command = f"ssh -n -o ConnectTimeout=2 {username}@{source} '{test_command}'"
+        username = host_config.get(source, 'username')  # get this host's username from the host_config file
+        # The remote side does need a single command string (ssh hands it to the remote shell); shlex.join quotes
+        #  each argument safely.
+        test_command = (["ssh", "-n"] + SSH_MULTIPLEX_ARGS
+                        + ["-o", "ConnectTimeout=2", f"{username}@{source}", shlex.join(test_command)])
+
+    return test_command
 
-    # this timestamp records the test start time, so we grab it here just before the test is executed
-    timestamp = datetime.now()
-    logger.info(f"Test ID {id_num} initiated. Running command: {test_command}")
 
-    # Data that appears in results_dict regardless of test type, or whether the test succeeds or fails
+def prepare_tests(tests: list) -> None:
+    """
+    Attach precomputed per-test fields to each test dict: '_is_local' (whether the test's source is the local
+    machine - see LOCAL_IDENTITIES in main()), '_cmd' (the fully-built argv list from build_command()),
+    '_cmd_str' (its printable shell form, for log messages and the results record) and '_json_stream' (whether
+    the command uses iperf3's NDJSON streaming output - see run_iperf3_streaming()).
+    These are immutable for the life of the run, so computing them once here leaves run_test() with nothing to do
+    but execute the command and parse the output. The underscore prefix marks them as internal fields rather than
+    CSV columns.
+    :param tests: the list of test dicts read from the input CSV (ie. all_tests). Modified in place.
+    :return: None
+    """
+    for t in tests:
+        # The user should not ever be putting an IP address into the 'source' field, but in case they do, we'll
+        #  try to handle it gracefully. Also note that on some systems (particularly home networks) gethostname()
+        #  will include ".local" or ".gateway". Lowercasing matches the normalization used for LOCAL_IDENTITIES.
+        t['_is_local'] = t.get('source', 'localhost').lower() in LOCAL_IDENTITIES
+        t['_cmd'] = build_command(t)
+        t['_cmd_str'] = shlex.join(t['_cmd'])
+        # Whether this command uses iperf3's NDJSON streaming output. Tested against the joined string rather
+        #  than the argv list because for remote tests the whole iperf3 invocation is shlex.join-ed into a single
+        #  SSH argument, so no individual list element equals "--json-stream".
+        t['_json_stream'] = "--json-stream" in t['_cmd_str']
+
+
+def run_ping_native(test_params: dict) -> dict:
+    """
+    Run a local-source latency test natively with icmplib instead of forking /usr/bin/ping and parsing its text
+    output - no subprocess, no text to scrape. The returned dict has exactly the same keys as
+    parse_ping_results(), and the statistics are computed from the raw per-probe RTTs in the same way, so the
+    results file is indistinguishable from the subprocess path. Only called when the optional icmplib dependency
+    is installed (see run_test()).
+    :param test_params: a dictionary containing the parameters for the test.
+    :return: a dictionary containing the parsed results of the ping test (same schema as parse_ping_results()).
+    """
+    id_num = test_params['id_number']
+    source = test_params.get('source', 'localhost')
+    destination = test_params['destination']
+    count = int(test_params.get('count', 10))
+    size = int(test_params.get('size', 56))
+
+    # privileged=False uses unprivileged datagram ICMP sockets, so no root/capabilities needed on Linux/macOS
+    host = icmp_ping(destination, count=count, interval=float(PING_INTERVAL), payload_size=size, privileged=False)
+
+    min_rtt, avg_rtt, max_rtt, stddev_rtt = None, None, None, None
+    packet_loss_percent = None
+    rtt_samples = [round(rtt, 3) for rtt in host.rtts]
+    packets_txd, packets_rxd = host.packets_sent, host.packets_received
+
+    if packets_txd:
+        packet_loss_percent = round(((packets_txd - packets_rxd) / packets_txd) * 100, 4)
+
+    if not rtt_samples:
+        logger.error(f"Test ID {id_num}: No ICMP echo replies received from {destination}. Recording packet "
+                     f"counts but no RTT statistics.")
+    else:
+        min_rtt, avg_rtt, max_rtt, stddev_rtt = rtt_statistics(rtt_samples)
+
+        # Same console/logfile success reporting as parse_ping_results() - see the comments there for rationale.
+        logger.info(f"Test ID {id_num} (src: '{source}', dst: '{destination}', ping): Success. Result: "
+                    f"{min_rtt}/{avg_rtt}/{max_rtt}/{stddev_rtt} ms (min/avg/max/*dev), "
+                    f"{packets_txd}/{packets_rxd}/{packet_loss_percent}% (#tx/#rx/loss)")
+
+    return {
+        "min_rtt": min_rtt,
+        "avg_rtt": avg_rtt,
+        "max_rtt": max_rtt,
+        "stddev_rtt": stddev_rtt,
+        "rtt_samples": rtt_samples,
+        "packets_txd": packets_txd,
+        "packets_rxd": packets_rxd,
+        "packet_loss_percent": packet_loss_percent,
+    }
+
+
+def run_test(test_params: dict) -> dict:
+    """
+    Run a test based on the parameters in the input dictionary. The dictionary should contain the following keys:
+    - id_num: a unique identifier for the test. Mandatory.
+    - source: the source IP or hostname for the test. Default is 'localhost' if not supplied.
+    - destination: the destination IP or hostname for the test. Mandatory.
+    - _cmd / _cmd_str / _is_local / _json_stream: the precomputed command argv list, its printable form, the
+      locality flag and the iperf3-streaming flag, all attached by prepare_tests().
+    :param test_params: a dictionary containing the parameters for the test
+    :return: a dictionary containing the results of the test
+    """
+    id_num = test_params['id_number']  # this is a required field, so we can assume it's present
+    source = test_params.get('source', 'localhost')  # if value was missing from CSV, assume 'localhost'
+    destination = test_params['destination']  # required field
+    test_command = test_params['_cmd']  # argv list fully built (incl. any SSH wrapper) by prepare_tests() at startup
+    command_str = test_params['_cmd_str']  # printable form, precomputed alongside the argv list
+
+    # This records the test start time, so we grab it here just before the test is executed. It's kept as a raw
+    #  time_ns() integer - no datetime object, no strftime - and rendered to the schema's ISO string once, on the
+    #  collection thread, when the result is serialized (see main()). The log record below carries its own
+    #  formatted time via the logging machinery, so nothing needs formatting here.
+    ts_ns = time.time_ns()
+    logger.info(f"Test ID {id_num} initiated. Running command: {command_str}")
+
+    # Data that appears in results_dict regardless of test type, or whether the test succeeds or fails. test_type
+    #  is included so each line of the JSONL results file is self-describing and can be grouped downstream.
     results_dict = {
         "id_number": id_num,
-        "timestamp": str(timestamp),
+        "test_type": test_params['test_type'],
+        "timestamp": ts_ns,
         "status": None,
         "source": source,
         "destination": destination,
-        "test_command": test_command
+        "test_command": command_str
     }
+    p_results = None  # set directly by the native ICMP path; otherwise produced by the parsers below
+
+    # If the startup preflight found this test's source host unreachable, fail fast instead of sitting through
+    #  a full SSH connect timeout to learn the same thing. Local tests never consult HOST_UP - they don't go
+    #  over SSH, so the port-22 probe says nothing about them (the local machine may not even run sshd).
+    if not test_params['_is_local'] and not HOST_UP.get(source, True):
+        logger.error(f"Test ID {id_num}: source host '{source}' failed the startup reachability check - "
+                     f"skipping without attempting SSH.")
+        results_dict["status"] = "Failure"
+        results_dict["error"] = "source host unreachable (preflight)"
+        return results_dict
 
+    global ICMP_NATIVE_OK
     try:
-        # Execute the command and get the result.
-        raw_output = subprocess.check_output(test_command, shell=True, stderr=subprocess.STDOUT).decode()
+        if test_params['test_type'] == "latency":
+            if test_params['_is_local'] and icmp_ping is not None and ICMP_NATIVE_OK:
+                # Native ICMP fast path: icmplib sends the echo requests from this process, so there's no
+                #  fork/exec of ping and no text parsing. Recorded as such, since the prebuilt command didn't run.
+                try:
+                    p_results = run_ping_native(test_params)
+                    results_dict["test_command"] = f"[native ICMP via icmplib] {command_str}"
+                except ICMPLibError as e:
+                    # The native path is an optimization, never a requirement - whatever icmplib's complaint,
+                    #  the system ping below still gets its chance at the test. If the kernel refuses
+                    #  unprivileged ICMP sockets (the RHEL-family default), that verdict applies to every test,
+                    #  so stop attempting the native path for the rest of the run.
+                    if isinstance(e, SocketPermissionError):
+                        ICMP_NATIVE_OK = False
+                        logger.warning(f"Native ICMP sockets not permitted on this machine ({e}). Falling back "
+                                       f"to the system ping for local latency tests.")
+                    else:
+                        logger.warning(f"Test ID {id_num}: native ICMP ping failed ({e}). Falling back to the "
+                                       f"system ping for this test.")
+            if p_results is None:
+                # Ping output is small (one short line per probe), so reading it through a pipe is fine. Note we
+                #  keep the raw bytes - decoding is deferred to the parser, so nothing is decoded on failure.
+                raw_output = subprocess.check_output(test_command, stderr=subprocess.STDOUT)
+        elif test_params['_json_stream']:
+            # This host's iperf3 supports NDJSON streaming output, so events are parsed as they arrive and only
+            #  the final summary is kept - see run_iperf3_streaming().
+            command_result = run_iperf3_streaming(test_command)
+        else:
+            # Legacy --json output (iperf3 builds without --json-stream) arrives as one JSON blob that can run to
+            #  many MB. check_output would gather it as a list of pipe-read chunks and then b''.join() them,
+            #  briefly holding two copies of the blob. Reading with read1() into a single bytearray grows one
+            #  buffer incrementally instead, and json.loads() accepts the bytearray directly - no final copy.
+            proc = subprocess.Popen(test_command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            raw_output = bytearray()
+            while chunk := proc.stdout.read1(65536):
+                raw_output.extend(chunk)
+            returncode = proc.wait()
+            if returncode != 0:
+                # Raise the same exception check_output would have, so both paths share the handler below.
+                raise subprocess.CalledProcessError(returncode, test_command, output=raw_output)
 
     except subprocess.CalledProcessError as e:
-        logger.error(f"Test failure for test ID {id_num} (command '{test_command}'). "
+        logger.error(f"Test failure for test ID {id_num} (command '{command_str}'). "
                      f"Full output of test command: {e.output.decode()}")
         results_dict["status"] = "Failure"
 
-    else:  # if the command didn't trigger a CalledProcessError, we can parse the results
-        p_results = parse_results(test_params=test_params, raw_output=raw_output)
-        logger.debug(f"Test ID {id_num} parsed results: {p_results}")
+    except OSError as e:
+        # Typically the test binary (ping/iperf3/ssh) isn't installed on this machine. Under the old shell=True
+        #  invocation this surfaced as exit 127 from the shell and landed in the handler above; with direct argv
+        #  execution the OS error reaches us here instead. Either way it's a per-test failure, not a crash.
+        logger.error(f"Test failure for test ID {id_num} (command '{command_str}'): {e}")
+        results_dict["status"] = "Failure"
+
+    else:  # if the command didn't trigger an exception, we can parse the results
+        try:
+            if p_results is not None:
+                pass  # the native ICMP path already returned parsed results - nothing left to parse
+            elif test_params['_json_stream']:
+                # Streaming runs have already been decoded into a legacy-shaped dict, so skip parse_results().
+                p_results = parse_iperf_results(test_params, command_result)
+            else:
+                p_results = parse_results(test_params=test_params, raw_output=raw_output)
+        except ValueError as e:
+            # The command exited 0 but produced output we couldn't make sense of (eg. json.loads() on something
+            #  that isn't the JSON shape we expected). One bad payload must be a per-test failure - letting it
+            #  propagate would crash the collection loop in main() and abort the whole run.
+            logger.error(f"Test ID {id_num}: could not parse test output ({e}). Recording test as failed.")
+            results_dict["status"] = "Failure"
+            return results_dict
+        # %-style (lazy) formatting: p_results can be large (eg. rtt_samples), and an f-string would stringify it
+        #  on every test even with DEBUG logging disabled. The logger only formats %s args if the record is emitted.
+        logger.debug("Test ID %s parsed results: %s", id_num, p_results)
         # This next check is because older iPerf3 versions can return exit code 0 under some failure conditions (eg.
         # connection refused), when --json is used. Luckily in these situations iPerf3 returns a JSON object with an
         # 'error' key. So parse_iperf_results() looks for this and passes on iPerf's 'error' key/value pair here.
@@ -536,109 +1194,274 @@ def run_test(test_params: dict) -> dict:
     return results_dict
 
 
-# This script will not work under Windows, for a couple of reasons. Firstly, the output of the ping command is vastly
-# different under Windows. Secondly, the command-line options for the Windows ping command are completely different.
-if os.name == 'nt':
-    print(f"FATAL: This script will not run on Windows systems. It is designed for execution on Unix-based "
-          f"operating systems. Halting execution.")
-    exit(1)
-
-# Record the start-time of program execution so we can output the duration at the end of the script
-execution_start_time = datetime.now()
-
-# Process command-line arguments
-args = get_cmdline_args()
-if args.verbose:
-    LOGGING_LEVEL = logging.DEBUG
-log_dir = args.log_dir
-input_csv = args.input
-results_dir = args.output
-host_config_file = args.host_config
-PING_INTERVAL = args.ping_interval
-
-# This must be checked *before* logging is enabled. Other directories/files are checked after logging is enabled.
-check_dir_and_permissions(dir_path=log_dir, description="Log directory", mode=os.W_OK | os.R_OK)
-
-# Append yyyymmddhhmmss timestamping to the output filename, eg. net-test_2024-03-19_125400.json
-results_prefix = f"{BASE_NAME}_results-"
-results_filename = f"{results_prefix}{datetime.now().strftime('%Y-%m-%d_%H%M%S')}.json"
-results_filepath = os.path.join(results_dir, f"{results_filename}")
-
-""""###############################################################################
-#   BEGIN LOGGER SETUP AS EARLY AS POSSIBLE TO ENSURE ALL OPERATIONS ARE LOGGED.  #
-#   AVOID ADDING CODE ABOVE THIS POINT TO PREVENT UNLOGGED OPERATIONS.            #
-################################################################################"""
-log_file = os.path.join(log_dir, f"{BASE_NAME}.log")
-logger = setup_logging(name=LOGGER_NAME, log_level=LOGGING_LEVEL, file_path=log_file)
-
-logger.info(f"{'*' * 20} Initial startup {'*' * 20}")
-logger.info(f"Input CSV file is: {input_csv}. Output file will be: {results_filepath}. "
-            f"Logging level: {logging.getLevelName(LOGGING_LEVEL)}.")
-print(f"Input CSV file is: {input_csv}. Output file will be: {results_filepath}")
-print(f"Logging to {log_file}. Logging level: {logging.getLevelName(LOGGING_LEVEL)}.")
-
-# Check that our input and output directories exist and have the correct permissions
-check_dir_and_permissions(dir_path=results_dir, description="Results directory", mode=os.W_OK)
-check_dir_and_permissions(dir_path=input_csv, description="Input file", mode=os.R_OK)
-
-if args.max_age is not None:
-    max_age_days = args.max_age
-    logger.info(f"Deleting results files older than {max_age_days} days.")
-    print(f"Deleting results files older than {max_age_days} days...")
-    delete_old_result_files(directory=results_dir, max_days=max_age_days)
-
-# Get the local hostname, FQDN and IP address. This is used to decide if a given test will be run locally, or via SSH.
-logger.debug("Getting local machine's hostname, FQDN and IP address.")
-my_hostname = socket.gethostname().lower().split('.')[0]  # Extract the part before the first dot
-my_fqdn = socket.getfqdn().lower()
-my_ip_addr = socket.gethostbyname(my_hostname)
-
-# The wording of this log entry is carefully chosen, to make it clear that 'my_ip_addr' is not pulled from the NIC
-#  the OS, it's derived by performing a lookup on my_hostname, which will use OS DNS settings or /etc/hosts.
-logger.info(f"My hostname: {my_hostname}. My FQDN: {my_fqdn}. DNS resolves {my_hostname} to {my_ip_addr}.")
-
-all_tests = read_input_file(input_csv)  # a list of dictionaries, each dict representing a test to be run
-
-if not test_data_validated_ok(all_tests):
-    logger.critical(f"Input file '{input_csv}' contains invalid data. Halting execution.")
-    exit(1)
-
-logger.info(f"Reading host configuration file {host_config_file}.")
-host_config = configparser.ConfigParser()
-host_config.read(host_config_file)
-
-# Check that the host_config file has corresponding entries for each unique test source hostname.
-if not host_config_validated_ok(all_tests):
-    logger.critical(f"Host configuration file '{host_config_file}' is missing entries for source hostnames. "
-                    f"Halting execution.")
-    exit(1)
-
-# initialise the all_results dictionary with its high-level keys
-all_results = {
-    "latency_tests": [],
-    "throughput_tests": [],
-    "jitter_tests": []
-}
-
-# Do the actual work - iterate over all_tests and run each test, appending the results to all_results
-for test in all_tests:
-    id_number = test['id_number']
-    test_type = test['test_type']
-
-    logger.debug(f"Test ID {id_number} of type '{test_type}' will be run.")
-    test_results = run_test(test)
-
-    # Append the results to the appropriate list in all_results
-    key_name = test_type + "_tests"
-    all_results[key_name].append(test_results)
-
-# Write the results to the output file in JSON format
-logger.info(f"All tests have been iterated over. Writing results to {results_filepath}.")
-with open(results_filepath, 'w') as json_file:
-    json.dump(all_results, json_file, indent=4)
-
-execution_duration = datetime.now() - execution_start_time
-# Create a string that expresses the duration in a human-readable format, hh:mm:ss
-execution_duration_str = str(execution_duration).split('.')[0]  # remove the microseconds from the string
-
-logger.info(f"{'*' * 20} End of script execution. Run-time was {execution_duration_str} {'*' * 20}")
+def group_latency_batches(tests: list) -> list:
+    """
+    Group the test list into "dispatch units" for the thread pool. Latency tests that are identical apart from
+    id_number (same source, destination, count and size) get coalesced into one unit, which
+    run_latency_batch() executes as a single ping invocation with the summed probe count - one fork/exec and,
+    for remote sources, one SSH round-trip, instead of N of each. Every other test is a unit of one and runs
+    exactly as before. Throughput and jitter tests are never coalesced: each iperf3 run is a measurement of
+    sustained load over its own window, so fusing two runs would change what is being measured, not just how
+    efficiently it is measured.
+    :param tests: the list of test dicts read from the input CSV (after prepare_tests()).
+    :return: a list of units, each a list of one or more test dicts, preserving CSV order of first appearance.
+    """
+    units = {}
+    for t in tests:
+        if t['test_type'] == "latency":
+            key = (t.get('source', 'localhost'), t['destination'], t.get('count', 10), t.get('size', 56))
+        else:
+            key = id(t)  # unique per dict, so non-latency tests can never share a unit
+        units.setdefault(key, []).append(t)
+    return list(units.values())  # dicts preserve insertion order, so units come out in CSV order
+
+
+def run_latency_batch(batch: list) -> list:
+    """
+    Run a batch of identical latency tests (as grouped by group_latency_batches()) as one ping invocation with
+    the summed probe count, then partition the per-probe RTTs back out to the individual id_numbers in CSV
+    order and recompute each test's statistics from its own slice of samples. One caveat: ping doesn't report
+    which specific probes went unanswered, so lost replies are attributed by assuming each test's replies are
+    the next 'count' consecutive samples - under packet loss, the shortfall lands on the later tests in the
+    batch. The batch-wide loss figure is always exact; the per-test split is best-effort.
+    :param batch: a list of two or more test dicts that differ only in id_number.
+    :return: a list of result dicts, one per test in the batch, each shaped exactly like run_test()'s.
+    """
+    total_count = sum(int(t.get('count', 10)) for t in batch)
+    id_numbers = [t['id_number'] for t in batch]
+    logger.info(f"Coalescing {len(batch)} identical latency tests (IDs {', '.join(id_numbers)}) into a single "
+                f"ping run of {total_count} probes.")
+
+    # Build a merged stand-in test from the first of the batch, with the summed count. Its command has to be
+    #  rebuilt since the precomputed one carries the original count.
+    merged = dict(batch[0])
+    merged['count'] = total_count
+    merged['_cmd'] = build_command(merged)
+    merged['_cmd_str'] = shlex.join(merged['_cmd'])
+    combined = run_test(merged)
+
+    if combined["status"] != "Success":
+        # The whole invocation failed (eg. unresolvable destination), so every test in the batch failed the
+        #  same way - fan the failure record out with each test's own id_number.
+        return [{**combined, "id_number": t['id_number']} for t in batch]
+
+    all_samples = combined.get('rtt_samples') or []
+    results = []
+    offset = 0
+    for t in batch:
+        sub_count = int(t.get('count', 10))
+        sub_samples = all_samples[offset:offset + sub_count]
+        offset += sub_count
+        sub_result = dict(combined)
+        sub_result['id_number'] = t['id_number']
+        sub_result['rtt_samples'] = sub_samples
+        (sub_result['min_rtt'], sub_result['avg_rtt'],
+         sub_result['max_rtt'], sub_result['stddev_rtt']) = rtt_statistics(sub_samples)
+        if combined.get('packets_txd') is not None:
+            sub_result['packets_txd'] = sub_count
+            sub_result['packets_rxd'] = len(sub_samples)
+            sub_result['packet_loss_percent'] = round(((sub_count - len(sub_samples)) / sub_count) * 100, 4)
+        results.append(sub_result)
+    return results
+
+
+def main():
+    """
+    Main driver for the script: parse the command-line arguments, set up logging, read and validate the input
+    files, run every test, and write out the results JSON. All of this used to live at module level; wrapping it
+    in main() behind the __name__ guard below means the module can be imported (eg. by tooling) without the whole
+    test run executing as a side effect, and guarantees the driver code runs exactly once.
+    """
+    # Several of the worker functions above read these as module-level globals, so declare them here.
+    global logger, host_config, input_csv, host_config_file, results_prefix, PING_INTERVAL, LOGGING_LEVEL, \
+        LOCAL_IDENTITIES, RESULT_CACHE_ENABLED, DISK_CACHE
+
+    # This script will not work under Windows, for a couple of reasons. Firstly, the output of the ping command is vastly
+    # different under Windows. Secondly, the command-line options for the Windows ping command are completely different.
+    if os.name == 'nt':
+        print(f"FATAL: This script will not run on Windows systems. It is designed for execution on Unix-based "
+              f"operating systems. Halting execution.")
+        exit(1)
+
+    # Record the start-time of program execution so we can output the duration at the end of the script. We use the
+    # monotonic clock for this, because unlike the wall clock it can't jump around (NTP adjustments, DST, etc), so the
+    # duration we report is always correct.
+    execution_start_time = time.monotonic()
+
+    # Process command-line arguments
+    args = get_cmdline_args()
+    if args.verbose:
+        LOGGING_LEVEL = logging.DEBUG
+    log_dir = args.log_dir
+    input_csv = args.input
+    results_dir = args.output
+    host_config_file = args.host_config
+    PING_INTERVAL = args.ping_interval
+    if args.no_cache:
+        RESULT_CACHE_ENABLED = False
+
+    # This must be checked *before* logging is enabled. Other directories/files are checked after logging is enabled.
+    check_dir_and_permissions(dir_path=log_dir, description="Log directory", mode=os.W_OK | os.R_OK)
+
+    # Append yyyymmddhhmmss timestamping to the output filename, eg. net-test_2024-03-19_125400.jsonl
+    results_prefix = f"{BASE_NAME}_results-"
+    results_filename = f"{results_prefix}{datetime.now().strftime('%Y-%m-%d_%H%M%S')}.jsonl"
+    results_filepath = os.path.join(results_dir, f"{results_filename}")
+
+    """"###############################################################################
+    #   BEGIN LOGGER SETUP AS EARLY AS POSSIBLE TO ENSURE ALL OPERATIONS ARE LOGGED.  #
+    #   AVOID ADDING CODE ABOVE THIS POINT TO PREVENT UNLOGGED OPERATIONS.            #
+    ################################################################################"""
+    log_file = os.path.join(log_dir, f"{BASE_NAME}.log")
+    logger = setup_logging(name=LOGGER_NAME, log_level=LOGGING_LEVEL, file_path=log_file)
+
+    logger.info(f"{'*' * 20} Initial startup {'*' * 20}")
+    logger.info(f"Input CSV file is: {input_csv}. Output file will be: {results_filepath}. "
+                f"Logging to {log_file}. Logging level: {logging.getLevelName(LOGGING_LEVEL)}.")
+
+    # Check that our input and output directories exist and have the correct permissions
+    check_dir_and_permissions(dir_path=results_dir, description="Results directory", mode=os.W_OK)
+    check_dir_and_permissions(dir_path=input_csv, description="Input file", mode=os.R_OK)
+
+    # Open the cross-run result cache if the optional diskcache package is installed (and caching wasn't turned
+    #  off). It lives alongside the results files; entries expire on their own, so no cleanup is needed.
+    if diskcache is not None and RESULT_CACHE_ENABLED:
+        DISK_CACHE = diskcache.Cache(os.path.join(results_dir, DISK_CACHE_DIRNAME))
+        logger.debug(f"Cross-run result cache open at {DISK_CACHE.directory} "
+                     f"(TTL {DISK_CACHE_TTL_SECONDS}s, override via ANT_CACHE_TTL).")
+
+    if args.max_age is not None:
+        max_age_days = args.max_age
+        logger.info(f"Deleting results files older than {max_age_days} days.")
+        delete_old_result_files(directory=results_dir, max_days=max_age_days)
+
+    # Get the local hostname, FQDN and IP address. This is used to decide if a given test will be run locally, or via SSH.
+    #  The default socket timeout is set first, so that no name lookup (here or in a worker thread later) can hang
+    #  indefinitely on a broken DNS entry.
+    socket.setdefaulttimeout(SOCKET_DEFAULT_TIMEOUT)
+    logger.debug("Getting local machine's hostname, FQDN and IP address.")
+    my_hostname = socket.gethostname().lower().split('.')[0]  # Extract the part before the first dot
+    my_fqdn = socket.getfqdn().lower()
+    my_ip_addr = resolve_hostname(my_hostname)
+
+    # The wording of this log entry is carefully chosen, to make it clear that 'my_ip_addr' is not pulled from the NIC
+    #  the OS, it's derived by performing a lookup on my_hostname, which will use OS DNS settings or /etc/hosts.
+    logger.info(f"My hostname: {my_hostname}. My FQDN: {my_fqdn}. DNS resolves {my_hostname} to {my_ip_addr}.")
+
+    # All the names/addresses this machine answers to, built once as a frozenset so the local-vs-remote decision in
+    #  run_test() is a single O(1) membership test rather than rebuilding a list and scanning it for every test.
+    LOCAL_IDENTITIES = frozenset({my_hostname, my_fqdn, my_ip_addr, "localhost", "127.0.0.1"})
+
+    all_tests = read_input_file(input_csv)  # a list of dictionaries, each dict representing a test to be run
+
+    if not test_data_validated_ok(all_tests):
+        logger.critical(f"Input file '{input_csv}' contains invalid data. Halting execution.")
+        exit(1)
+
+    logger.info(f"Reading host configuration file {host_config_file}.")
+    host_config = configparser.ConfigParser()
+    host_config.read(host_config_file)
+
+    # Check that the host_config file has corresponding entries for each unique test source hostname.
+    if not host_config_validated_ok(all_tests):
+        logger.critical(f"Host configuration file '{host_config_file}' is missing entries for source hostnames. "
+                        f"Halting execution.")
+        exit(1)
+
+    # Open a persistent SSH master connection to each unique remote source host, so the per-test ssh commands
+    #  (and the iperf3 capability probes in prepare_tests) can multiplex over them instead of handshaking from
+    #  scratch every time. Locality is decided with the same lowercased membership test prepare_tests() uses for
+    #  '_is_local', so a source whose CSV spelling differs in case from the local hostname can't end up treated
+    #  as local there but remote here. The original casing is kept in the set itself, because it's also the key
+    #  into the host_config sections (configparser section names are case-sensitive).
+    remote_sources = {t.get('source', 'localhost') for t in all_tests
+                      if t.get('source', 'localhost').lower() not in LOCAL_IDENTITIES}
+
+    # Establish which remote sources are actually reachable before spending any time on SSH handshakes; masters
+    #  are then only opened to hosts that answered.
+    preflight_check_sources(remote_sources)
+    open_ssh_masters({s for s in remote_sources if HOST_UP.get(s, True)})
+
+    # Precompute each test's locality flag and full command string, so the worker threads don't redo that work.
+    prepare_tests(all_tests)
+
+    # Do the actual work - run the tests in a thread pool, streaming results to the output file as tests complete.
+    #  Each test spends virtually all of its wall time blocked on ping/iperf3/ssh (and check_output releases the
+    #  GIL while waiting on the subprocess), so threads give us genuine concurrency: total runtime approaches that
+    #  of the slowest test rather than the sum of all of them. A per-source semaphore stops any one source host
+    #  being asked to run more than MAX_CONCURRENT_PER_SOURCE tests at once.
+    source_semaphores = {t.get('source', 'localhost'): threading.Semaphore(MAX_CONCURRENT_PER_SOURCE)
+                         for t in all_tests}
+
+    # Coalesce latency tests that are identical apart from id_number into single ping runs - see
+    #  group_latency_batches(). Each unit occupies one worker thread and one semaphore slot.
+    dispatch_units = group_latency_batches(all_tests)
+    max_workers = max(1, min(args.max_workers, len(dispatch_units)))
+    logger.info(f"Running {len(all_tests)} tests as {len(dispatch_units)} dispatch units, with up to "
+                f"{max_workers} concurrent worker threads (max {MAX_CONCURRENT_PER_SOURCE} per source host).")
+
+    # Results are streamed to the output file as line-delimited JSON (one object per line), written as each test
+    #  completes. This keeps memory flat regardless of how many tests there are, and means a crash or Ctrl-C still
+    #  leaves every completed test's results on disk - with the old single json.dump() at the end, a crash lost
+    #  everything. Each line carries its own test_type key, so consumers can group results themselves.
+    #  The file is opened once with a 1MB buffer, so however many lines a unit produces, they hit the OS in a
+    #  single write() when we flush - we never cycle the FD or let the io layer flush per-newline (binary mode
+    #  has no line buffering). Flushing happens once per completed unit, not per line: that's the crash-safety
+    #  boundary, and at our test rates (dozens of units per run) its cost is noise. No dedicated writer thread is
+    #  needed - only the collection loop below ever touches the file, so there's no contention on the buffer.
+    # Live metrics socket (see INFLUX_HOST above). UDP is fire-and-forget: a missing or slow InfluxDB can never
+    #  stall the collection loop, and losing the odd datagram is fine because the JSONL file has everything.
+    influx_sock = None
+    if INFLUX_HOST:
+        influx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        logger.info(f"Streaming results to InfluxDB at {INFLUX_HOST}:{INFLUX_PORT} (UDP line protocol).")
+
+    try:
+        with open(results_filepath, 'wb', buffering=1 << 20) as json_file, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            future_to_unit = {}
+            for unit in dispatch_units:
+                logger.debug("Test ID(s) %s of type '%s' will be run.",
+                             [t['id_number'] for t in unit], unit[0]['test_type'])
+                future_to_unit[executor.submit(run_unit_throttled, unit, source_semaphores)] = unit
+
+            # Collect results as units finish. Note this means lines appear in the file in completion order, not
+            #  CSV order - consumers should key off id_number, which is unchanged.
+            for future in concurrent.futures.as_completed(future_to_unit):
+                for test_results in future.result():
+                    # Ship the live metrics datagram first, while the timestamp is still the raw ns integer
+                    #  that line protocol wants.
+                    if influx_sock is not None:
+                        try:
+                            influx_sock.sendto(influx_line(test_results), (INFLUX_HOST, INFLUX_PORT))
+                        except OSError as e:
+                            logger.warning(f"Could not send test ID {test_results['id_number']} result to "
+                                           f"InfluxDB at {INFLUX_HOST}:{INFLUX_PORT}: {e}")
+                    # Workers record the start time as a raw time.time_ns() integer; render it to the ISO string
+                    #  the results schema has always used here on the collection thread, keeping the datetime
+                    #  construction and formatting off the worker threads entirely.
+                    test_results["timestamp"] = datetime.fromtimestamp(
+                        test_results["timestamp"] / 1e9).isoformat(sep=" ", timespec="seconds")
+                    json_file.write(dumps_jsonl(test_results))
+                json_file.flush()  # so a crash mid-run can't lose results of tests that already completed
+
+            # Push the completed file all the way to disk before declaring victory - flush() only hands the
+            #  buffer to the OS; fsync() survives a power cut. Once per run, so the cost is irrelevant.
+            json_file.flush()
+            os.fsync(json_file.fileno())
+    finally:
+        # Always tear the SSH master connections down, even if a test raised and we're about to crash out.
+        close_ssh_masters(remote_sources)
+
+    logger.info(f"All tests have been iterated over. Results were streamed to {results_filepath}.")
+
+    execution_duration = timedelta(seconds=time.monotonic() - execution_start_time)
+    # Create a string that expresses the duration in a human-readable format, hh:mm:ss
+    execution_duration_str = str(execution_duration).split('.')[0]  # remove the microseconds from the string
+
+    logger.info(f"{'*' * 20} End of script execution. Run-time was {execution_duration_str} {'*' * 20}")
+
+
+
+if __name__ == "__main__":
+    main()